@@ -2,15 +2,23 @@
 
 import argparse
 import logging
-import csv
 from collections import namedtuple
-import random
-import itertools
+import numpy as np
+try:
+    from numba import njit, prange
+    NUMBA_AVAILABLE = True
+except ImportError:
+    NUMBA_AVAILABLE = False
 
 Formula = namedtuple("Formula", "m c fitness")
-DataPoint = namedtuple("DataPoint", "x y")
 MCRange = namedtuple("MCRange", "minM maxM minC maxC")
-HyperParams = namedtuple("HyperParams", "cycles mcrange popSize mutProb mutVal dps tournamentSize goldenSize immigrationSize")
+Population = namedtuple("Population", "m c fitness")
+HyperParams = namedtuple("HyperParams", "cycles mcrange popSize mutProb mutVal dps tournamentSize goldenSize immigrationSize tournN goldenN breedN mTicks cTicks mutTicks patience selection device")
+
+_FIT_CACHE = {}
+CUDA_LOADED = False
+_SCORE_BLOCK = 2**20
+_CACHE_TABLE_LIMIT = 2**24
 
 def __parseArgs():
     parser = argparse.ArgumentParser(description='Supply 2 Column CSV of Y, X data')
@@ -27,124 +35,245 @@ def __parseArgs():
     parser.add_argument("--tournamentSize", type=float, help="Percentage of population involved in tournament (expressed as decimal between 0 and 1)", metavar="tournamentSize", nargs="?", default=0.08)
     parser.add_argument("--goldenSize", type=float, help="Percentage of base population that base population will be reduced to via selection (expressed as decimal between 0 and 1)", metavar="tournamentSize", nargs="?", default=0.4)
     parser.add_argument("--verbosity", type=int, help="Amount of verbiage to display (Debug)", metavar="Verbosity", default=2, choices=[1, 2, 3, 4, 5], nargs="?")
+    parser.add_argument("--selection", type=str, help="Selection scheme used to reduce the base population to the golden population", metavar="selection", default="tournament", choices=["tournament", "elitist"], nargs="?")
+    parser.add_argument("--device", type=str, help="Device to score fitness on (gpu requires numba with CUDA, otherwise falls back to cpu)", metavar="device", default="cpu", choices=["cpu", "gpu"], nargs="?")
+    parser.add_argument("--patience", type=int, help="Stop early once selection has converged on a single candidate this many times without the best fitness improving", metavar="patience", nargs="?", default=50)
+    parser.add_argument("--seed", type=int, help="Seed for the random number generator (random if omitted)", metavar="seed", nargs="?", default=None)
     parser.add_argument("--immigrationSize", type=float, help="Percentage of base population that is completely new each cycle (expressed as decimal between 0 and 1)", metavar="immigrationSize", nargs="?", default=0.2)
     args = parser.parse_args()
-    mcrange = MCRange(args.minM, args.maxM, args.minC, args.maxC)
-    hyperParams = HyperParams(args.cycles, mcrange, args.popSize, args.mutProb, args.mutVal, args.dps, args.tournamentSize, args.goldenSize, args.immigrationSize)
-    return (args.path[0], hyperParams, args.verbosity)
+    try:
+        hyperParams = createHyperParams(args.cycles, MCRange(args.minM, args.maxM, args.minC, args.maxC), args.popSize, args.mutProb, args.mutVal, args.dps, args.tournamentSize, args.goldenSize, args.immigrationSize, args.patience, args.selection, args.device)
+    except ValueError as e:
+        parser.error(str(e))
+    return (args.path[0], hyperParams, args.verbosity, args.seed)
 
+def createHyperParams(cycles, mcrange, popSize, mutProb, mutVal, dps, tournamentSize, goldenSize, immigrationSize, patience=50, selection="tournament", device="cpu"):
+    if mcrange.maxM < mcrange.minM or mcrange.maxC < mcrange.minC:
+        raise ValueError("maxM and maxC must not be smaller than minM and minC")
+    tournN = int(round(popSize*tournamentSize, 0))
+    goldenN = int(round(popSize*goldenSize, 0))
+    breedN = int(popSize*(1-immigrationSize))
+    if dps < 0:
+        raise ValueError("dps must not be negative")
+    bounds = [bound * 10**dps for bound in mcrange]
+    if any(abs(bound - round(bound)) > 1e-9 for bound in bounds):
+        raise ValueError("minM, maxM, minC and maxC must be whole multiples of {}".format(10**-dps))
+    (minM, maxM, minC, maxC) = (round(bound) for bound in bounds)
+    mTicks = maxM - minM
+    cTicks = maxC - minC
+    mutTicks = max(1, int(round(mutVal * 10**dps)))
+    if mTicks >= 2**32 or cTicks >= 2**32 or (mTicks+1) * (cTicks+1) >= 2**63:
+        raise ValueError("M/C range too large for {} dps, reduce the range or dps".format(dps))
+    return HyperParams(cycles, mcrange, popSize, mutProb, mutVal, dps, tournamentSize, goldenSize, immigrationSize, tournN, goldenN, breedN, mTicks, cTicks, mutTicks, patience, selection, device)
 
 def __getData(path):
-    data = []
-    with open(path, newline='') as csvfile:
-        dataFile = csv.reader(csvfile, delimiter=',')
-        for row in dataFile:
-            data.append(DataPoint(float(row[0]), float(row[1])))
-    logging.debug("Data acquired as " + str(data))
-    return data
-
-def __createPopulation(mcrange, dps, popSize):
-    logging.debug("Creating new population with popSize " + str(popSize))
-    return [Formula(round(random.uniform(mcrange.minM, mcrange.maxM), dps), round(random.uniform(mcrange.minC, mcrange.maxC), dps), None) for _ in range(popSize)]
-
-def __best(population):
-    logging.debug("Returning the best of " + str(population))
-    return sorted(population, key=lambda ind: ind.fitness)[0]
-
-def __scorePopulation(population, data, hyperParams):
-    logging.debug("Scoring whole population of size " + str(len(population)))
-    return [Formula(candidate.m, candidate.c, candidate.fitness or __score(candidate, data)) for candidate in population]
-
-def __score(candidate, data):
-    logging.debug("Scoring candidate " + str(candidate))
-    return sum([abs(round(datapoint.y - ((candidate.m*datapoint.x)+candidate.c), hyperParams.dps)) for datapoint in data])
-
-def __selectPopulation(population, hyperParams):
-    logging.debug("Selecting the best " + str(int(round(hyperParams.goldenSize * len(population)))) + " from population of size " + str(len(population)))
-    return [__best(random.sample(population, int(round(hyperParams.popSize*hyperParams.tournamentSize, 0)))) for _ in range(int(round(hyperParams.popSize*hyperParams.goldenSize, 0)))]
-
-def __potentialChildren(population):
-    ms, cs = [], []
-    for cand in population:
-        ms.append(cand.m)
-        cs.append(cand.c)
-    potentials = set([(cand[1], cand[0]) for cand in list(itertools.product(ms, cs))] + list(itertools.product(ms, cs)))
-    logging.debug("This population has the potential to have the following children: " + str(potentials))
-    return [Formula(pot[0], pot[1], None)for pot in potentials]
-
-def __breedPopulation(population, hyperParams):
-    pool = __potentialChildren(population)
-    logging.debug("Breeding population of size " + str(len(pool)))
-    children = random.sample(pool, int(min(len(pool), (hyperParams.popSize*(1-hyperParams.immigrationSize))-len(population))))
-    logging.debug(str(len(children)) + " children generated")
-    mutatedChildren = __mutate(children, hyperParams)
-    immigrants = hyperParams.popSize - (len(children) + len(population))
-    logging.debug("Immigrants to be inserted " + str(immigrants))
-    population += list(children) + __createPopulation(hyperParams.mcrange, hyperParams.dps, immigrants)
-    if len(population) != hyperParams.popSize:
-        raise ValueError("Population is length {} and required to be {}".format(len(population), hyperParams.popSize))
+    data = np.loadtxt(path, delimiter=',', dtype=np.float64, usecols=(0, 1), ndmin=2)
+    logging.debug("Data acquired as %s", data)
+    return (np.ascontiguousarray(data[:, 0]), np.ascontiguousarray(data[:, 1]))
+
+def __createPopulation(hyperParams, popSize, rng):
+    logging.debug("Creating new population with popSize %s", popSize)
+    return Population(rng.integers(0, hyperParams.mTicks+1, popSize, dtype=np.uint32), rng.integers(0, hyperParams.cTicks+1, popSize, dtype=np.uint32), np.full(popSize, np.nan))
+
+def __decode(ticks, low, dps):
+    return ((low * 10**dps) + ticks.astype(np.int64)) / 10**dps
+
+def __pack(population, hyperParams):
+    return (population.m.astype(np.int64) * (hyperParams.cTicks+1)) + population.c
+
+def __subPopulation(population, indices):
+    return Population(population.m[indices], population.c[indices], population.fitness[indices])
+
+def __createCache(hyperParams):
+    if (hyperParams.mTicks+1) * (hyperParams.cTicks+1) <= _CACHE_TABLE_LIMIT:
+        return np.full((hyperParams.mTicks+1) * (hyperParams.cTicks+1), np.nan)
+    logging.info("M/C grid too large for a fitness table, caching fitness in a dict")
+    return {}
+
+def __cacheLookup(keys):
+    if isinstance(_FIT_CACHE, dict):
+        return np.fromiter((_FIT_CACHE.get(key, np.nan) for key in keys.tolist()), np.float64, len(keys))
+    return _FIT_CACHE[keys]
+
+def __cacheStore(keys, fitness):
+    if isinstance(_FIT_CACHE, dict):
+        _FIT_CACHE.update(zip(keys.tolist(), fitness.tolist()))
+    else:
+        _FIT_CACHE[keys] = fitness
+
+def __best(population, hyperParams):
+    logging.debug("Returning the best of %s", population)
+    i = np.argmin(population.fitness)
+    m = __decode(population.m[i:i+1], hyperParams.mcrange.minM, hyperParams.dps)[0]
+    c = __decode(population.c[i:i+1], hyperParams.mcrange.minC, hyperParams.dps)[0]
+    return Formula(float(m), float(c), float(population.fitness[i]))
+
+def __scorePopulation(population, dataX, dataY, hyperParams):
+    logging.debug("Scoring whole population of size %s", len(population.fitness))
+    fitness = population.fitness.copy()
+    keys = __pack(population, hyperParams)
+    unscored = np.flatnonzero(np.isnan(fitness))
+    uniqueKeys, first, inverse = np.unique(keys[unscored], return_index=True, return_inverse=True)
+    representatives = unscored[first]
+    logging.debug("%s unscored candidates of which %s are distinct", len(unscored), len(uniqueKeys))
+    uniqueFitness = __cacheLookup(uniqueKeys)
+    missing = np.isnan(uniqueFitness)
+    if missing.any():
+        ms = __decode(population.m[representatives[missing]], hyperParams.mcrange.minM, hyperParams.dps)
+        cs = __decode(population.c[representatives[missing]], hyperParams.mcrange.minC, hyperParams.dps)
+        uniqueFitness[missing] = __score(ms, cs, dataX, dataY, hyperParams.dps, hyperParams.device)
+        __cacheStore(uniqueKeys[missing], uniqueFitness[missing])
+    fitness[unscored] = uniqueFitness[inverse]
+    return Population(population.m, population.c, fitness)
+
+def __score(ms, cs, dataX, dataY, dps, device):
+    logging.debug("Scoring %s candidates", len(ms))
+    if device == "gpu":
+        fitness = cuda.device_array(len(ms))
+        __gpuScoreKernel[(len(ms)+255) // 256, 256](cuda.to_device(ms), cuda.to_device(cs), dataX, dataY, 10.0**dps, fitness)
+        return fitness.copy_to_host()
+    if NUMBA_AVAILABLE:
+        return __scoreKernel(ms, cs, dataX, dataY, dps)
+    fitness = np.empty(len(ms))
+    step = max(1, _SCORE_BLOCK // max(1, len(dataX)))
+    for start in range(0, len(ms), step):
+        block = slice(start, start + step)
+        fitness[block] = np.abs(np.round(dataY - ((ms[block, None]*dataX)+cs[block, None]), dps)).sum(axis=1)
+    return fitness
+
+if NUMBA_AVAILABLE:
+    @njit(parallel=True, fastmath={"reassoc"}, cache=True)
+    def __scoreKernel(ms, cs, dataX, dataY, dps):
+        fitness = np.empty(ms.shape[0])
+        scale = 10.0**dps
+        for i in prange(ms.shape[0]):
+            total = 0.0
+            m = ms[i]
+            c = cs[i]
+            for j in range(dataX.shape[0]):
+                total += abs(np.rint((dataY[j] - ((m*dataX[j])+c))*scale)/scale)
+            fitness[i] = total
+        return fitness
+
+def __gpuScore(ms, cs, dataX, dataY, scale, fitness):
+    i = cuda.grid(1)
+    if i < ms.shape[0]:
+        total = 0.0
+        m = ms[i]
+        c = cs[i]
+        for j in range(dataX.shape[0]):
+            residual = dataY[j] - (libdevice.dmul_rn(m, dataX[j])+c)
+            total += abs(libdevice.rint(libdevice.dmul_rn(residual, scale))/scale)
+        fitness[i] = total
+
+def __loadCuda():
+    global cuda, libdevice, CUDA_LOADED, __gpuScoreKernel
+    if not CUDA_LOADED:
+        try:
+            from numba import cuda
+            from numba.cuda import libdevice
+        except ImportError:
+            return False
+        if not cuda.is_available():
+            return False
+        __gpuScoreKernel = cuda.jit(__gpuScore)
+        CUDA_LOADED = True
+    return True
+
+def __selectPopulation(population, hyperParams, rng):
+    if hyperParams.selection == "elitist":
+        return __selectElitePopulation(population, hyperParams)
+    logging.debug("Selecting the best %s from population of size %s", hyperParams.goldenN, len(population.fitness))
+    contestants = rng.integers(0, len(population.fitness), (hyperParams.goldenN, hyperParams.tournN))
+    winners = contestants[np.arange(hyperParams.goldenN), population.fitness[contestants].argmin(axis=1)]
+    return __subPopulation(population, winners)
+
+def __selectElitePopulation(population, hyperParams):
+    logging.debug("Selecting the fittest %s from population of size %s", hyperParams.goldenN, len(population.fitness))
+    return __subPopulation(population, np.argpartition(population.fitness, hyperParams.goldenN-1)[:hyperParams.goldenN])
+
+def __breedPopulation(population, hyperParams, rng):
+    logging.debug("Breeding population of size %s", len(population.fitness))
+    childCount = max(0, hyperParams.breedN-len(population.fitness)) if len(population.fitness) else 0
+    children = __crossover(population, rng.integers(0, len(population.fitness), childCount), rng.integers(0, len(population.fitness), childCount))
+    logging.debug("%s children generated", len(children.fitness))
+    children = __mutate(children, hyperParams, rng)
+    immigrants = hyperParams.popSize - (len(children.fitness) + len(population.fitness))
+    logging.debug("Immigrants to be inserted %s", immigrants)
+    population = Population(np.concatenate([population.m, children.m, rng.integers(0, hyperParams.mTicks+1, immigrants, dtype=np.uint32)]),
+                            np.concatenate([population.c, children.c, rng.integers(0, hyperParams.cTicks+1, immigrants, dtype=np.uint32)]),
+                            np.concatenate([population.fitness, children.fitness, np.full(immigrants, np.nan)]))
+    assert len(population.fitness) == hyperParams.popSize, "Population is length {} and required to be {}".format(len(population.fitness), hyperParams.popSize)
     return population
 
-def __crossover(a, b):
-    return Formula(a.m, b.c, None)
-
-def __mutate(children, hyperParams):
-    mutatedChildren = set()
-    counter = 0
-    for child in children:
-        m = child.m
-        c = child.c
-        if random.random() < hyperParams.mutProb:
-            direction = round(random.random()-0.5, 0)
-            counter += 1
-            if random.random() < 0.5:
-                m += (hyperParams.mutVal * direction)
-                logging.debug("Mutating child " + str(child) + "by adding " + str(hyperParams.mutVal * direction) + "to m")
-            else:
-                c += (hyperParams.mutVal * direction)
-                logging.debug("Mutating child " + str(child) + "by adding " + str(hyperParams.mutVal * direction) + "to c")
-        else:
-            logging.debug("Child with properties m, c " + str((m, c),) + " avoided mutation")
-        mutatedChildren.add(Formula(m, c, None))
-    logging.debug("A total of " + str(counter) + " children were mutated. " + str(round(len(children) * hyperParams.mutProb, 1)) + " predicted.")
-    return mutatedChildren
+def __crossover(population, a, b):
+    return Population(population.m[a], population.c[b], np.full(len(a), np.nan))
+
+def __mutate(children, hyperParams, rng):
+    mutated = rng.random(len(children.fitness)) < hyperParams.mutProb
+    toM = rng.random(len(children.fitness)) < 0.5
+    step = np.where(rng.random(len(children.fitness)) < 0.5, 1, -1) * hyperParams.mutTicks
+    ms = np.clip(children.m.astype(np.int64) + np.where(mutated & toM, step, 0), 0, hyperParams.mTicks)
+    cs = np.clip(children.c.astype(np.int64) + np.where(mutated & ~toM, step, 0), 0, hyperParams.cTicks)
+    logging.debug("A total of %s children were mutated. %s predicted.", np.count_nonzero(mutated), round(len(children.fitness) * hyperParams.mutProb, 1))
+    mutatedChildren = np.unique(np.stack([ms, cs], axis=1).astype(np.uint32), axis=0)
+    return Population(mutatedChildren[:, 0], mutatedChildren[:, 1], np.full(len(mutatedChildren), np.nan))
 
 def setup():
-    (path, hyperParams, verbosity) = __parseArgs()
-    random.seed()
+    (path, hyperParams, verbosity, seed) = __parseArgs()
+    rng = np.random.default_rng(seed)
     logging.basicConfig(filename='debug.log', level=verbosity*10)
-    logging.info("Path = " + path)
-    logging.info("Verbosity = " + str(verbosity))
-    logging.info("HyperParams = " + str(hyperParams))
-    data = __getData(path)
-    return (data, hyperParams)
-
-def evolve(data, hyperParams):
-    basePopulation = __createPopulation(hyperParams.mcrange, hyperParams.dps, hyperParams.popSize)
+    logging.info("Path = %s", path)
+    logging.info("Verbosity = %s", verbosity)
+    logging.info("HyperParams = %s", hyperParams)
+    logging.info("Seed = %s", seed)
+    (dataX, dataY) = __getData(path)
+    return (dataX, dataY, hyperParams, rng)
+
+def evolve(dataX, dataY, hyperParams, rng=None):
+    if rng is None:
+        rng = np.random.default_rng()
+    if hyperParams.device == "gpu":
+        if __loadCuda():
+            (dataX, dataY) = (cuda.to_device(dataX), cuda.to_device(dataY))
+        else:
+            logging.warning("CUDA is not available, scoring on the cpu instead")
+            hyperParams = hyperParams._replace(device="cpu")
+    global _FIT_CACHE
+    _FIT_CACHE = __createCache(hyperParams)
+    basePopulation = __createPopulation(hyperParams, hyperParams.popSize, rng)
+    bestFitness, stalled = np.inf, 0
     for i in range(hyperParams.cycles):
-        logging.info("Starting iteration " + str(i+1) + " of " + str(hyperParams.cycles))
-        logging.info("Base population size: " + str(len(basePopulation)))
-        logging.debug("Base population: " + str(basePopulation))
-        fitPopulation = __scorePopulation(basePopulation, data, hyperParams)
-        logging.info("Fit population size: " + str(len(fitPopulation)))
-        logging.debug("Fit population: " + str(fitPopulation))
-        best = __best(fitPopulation)
-        logging.info("Best candidate: " + str(best))
+        logging.info("Starting iteration %s of %s", i+1, hyperParams.cycles)
+        logging.info("Base population size: %s", len(basePopulation.fitness))
+        logging.debug("Base population: %s", basePopulation)
+        fitPopulation = __scorePopulation(basePopulation, dataX, dataY, hyperParams)
+        logging.info("Fit population size: %s", len(fitPopulation.fitness))
+        logging.debug("Fit population: %s", fitPopulation)
+        best = __best(fitPopulation, hyperParams)
+        logging.info("Best candidate: %s", best)
+        if best.fitness < bestFitness:
+            bestFitness, stalled = best.fitness, 0
         if best.fitness == 0:
-            logging.info("Best possible case identified. Returning with " + str(best))
+            logging.info("Best possible case identified. Returning with %s", best)
             return (best, i+1)
-        bestPopulation = __selectPopulation(fitPopulation, hyperParams)
-        logging.info("Best Population size " + str(len(bestPopulation)))
-        logging.debug("Best Population: " + str(bestPopulation))
+        bestPopulation = __selectPopulation(fitPopulation, hyperParams, rng)
+        logging.info("Best Population size %s", len(bestPopulation.fitness))
+        logging.debug("Best Population: %s", bestPopulation)
+        if np.unique(__pack(bestPopulation, hyperParams)).size == 1:
+            stalled += 1
+            if stalled >= hyperParams.patience:
+                logging.info("Population converged on %s for %s cycles without improvement. Returning", best, stalled)
+                return (best, i+1)
         if i+1 < hyperParams.cycles:
-            basePopulation = __breedPopulation(bestPopulation, hyperParams)
+            basePopulation = __breedPopulation(bestPopulation, hyperParams, rng)
         else:
-            basePopulation = bestPopulation
-    return (__best(basePopulation), hyperParams.cycles)
+            basePopulation = fitPopulation
+    return (__best(basePopulation, hyperParams), hyperParams.cycles)
 
 if __name__ == "__main__":
-    (data, hyperParams) = setup()
-    (best, completed) = evolve(data, hyperParams)
-    print("Best Candidate found with fitness of {fitness} and formula of {m}x+{c} after {cycles}".format(fitness=best.fitness, m=best.m, c=best.c, cycles=hyperParams.cycles))
+    (dataX, dataY, hyperParams, rng) = setup()
+    (best, completed) = evolve(dataX, dataY, hyperParams, rng)
+    print("Best Candidate found with fitness of {fitness} and formula of {m}x+{c} after {cycles}".format(fitness=best.fitness, m=best.m, c=best.c, cycles=completed))
 
 
@@ -0,0 +1,55 @@
+import unittest
+import numpy as np
+import evolium
+
+score = vars(evolium)["__score"]
+
+
+class ScoreTest(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        self.dataX = np.round(rng.uniform(-10, 10, 1000), 2)
+        self.dataY = np.round(rng.uniform(-10, 10, 1000), 2)
+        self.ms = np.round(rng.uniform(-10, 10, 5000), 2)
+        self.cs = np.round(rng.uniform(-10, 10, 5000), 2)
+
+    @unittest.skipUnless(evolium.NUMBA_AVAILABLE, "numba is not installed")
+    def test_kernel_matches_numpy(self):
+        for dps in (1, 2):
+            kernel = score(self.ms, self.cs, self.dataX, self.dataY, dps, "cpu")
+            evolium.NUMBA_AVAILABLE = False
+            try:
+                expected = score(self.ms, self.cs, self.dataX, self.dataY, dps, "cpu")
+            finally:
+                evolium.NUMBA_AVAILABLE = True
+            np.testing.assert_allclose(kernel, expected, rtol=0, atol=1e-8)
+
+
+class CreateHyperParamsTest(unittest.TestCase):
+    def create(self, mcrange, dps=1):
+        return evolium.createHyperParams(100, mcrange, 100, 0.01, 0.05, dps, 0.08, 0.4, 0.2)
+
+    def test_ticks_are_integers(self):
+        hyperParams = self.create(evolium.MCRange(0.5, 10.5, 0, 10))
+        self.assertEqual((hyperParams.mTicks, hyperParams.cTicks), (100, 100))
+        self.assertIsInstance(hyperParams.mTicks, int)
+
+    def test_rejects_bounds_off_the_grid(self):
+        with self.assertRaises(ValueError):
+            self.create(evolium.MCRange(0.05, 10, 0, 10))
+
+    def test_rejects_negative_dps(self):
+        with self.assertRaises(ValueError):
+            self.create(evolium.MCRange(0, 100, 0, 100), dps=-1)
+
+
+class EvolveTest(unittest.TestCase):
+    def test_empty_golden_population_refills_with_immigrants(self):
+        for selection in ("tournament", "elitist"):
+            hyperParams = evolium.createHyperParams(5, evolium.MCRange(0, 100, 0, 100), 100, 0.01, 0.05, 1, 0.08, 0, 0.2, selection=selection)
+            (best, completed) = evolium.evolve(np.array([5.0, 10.0]), np.array([10.0, 20.0]), hyperParams, np.random.default_rng(0))
+            self.assertGreaterEqual(best.fitness, 0)
+
+
+if __name__ == "__main__":
+    unittest.main()